@@ -1,53 +1,98 @@
 import os
 import io
+import asyncio
+import atexit
+import fcntl
+import queue
 import datetime
+import hashlib
+import json
 import time
-import tempfile
-from flask import Flask, render_template, request, jsonify
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+import httplib2
+import numpy as np
+from PyPDF2 import PdfReader
+import orjson
+from quart import Quart, render_template, request
 import google.generativeai as genai
+from google.generativeai import caching
+from google.api_core import exceptions as google_exceptions
 from google.oauth2 import service_account
+from google.auth.transport.requests import AuthorizedSession
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.http import HttpRequest
+from google_auth_httplib2 import AuthorizedHttp
+from google.resumable_media.requests import ChunkedDownload
+from cachetools import TTLCache
 import gspread
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import (
+    GENAI_API_KEY, SERVICE_ACCOUNT_FILE, DRIVE_FOLDER_ID, SPREADSHEET_ID, TARGET_ROLES,
+    LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, REPLY_CACHE_SIZE, REPLY_CACHE_TTL, SEMANTIC_CACHE_THRESHOLD,
+    CHAT_WORKERS, HISTORY_TURNS, INGEST_WORKERS, DOWNLOAD_CHUNK_SIZE, UPLOAD_POLL_INITIAL_DELAY, UPLOAD_POLL_MAX_DELAY, UPLOAD_POLL_TIMEOUT,
+    UPLOAD_POLL_BACKOFF, UPLOAD_POLL_WORKERS,
+    INLINE_PDF_BUDGET, INGEST_INDEX_FILE, INGEST_LOCK_FILE,
+    EMBEDDING_MODEL, EMBED_TEXT_LIMIT, RETRIEVAL_TOP_K,
+    MODEL_NAME, CACHE_TTL, CACHE_REFRESH_INTERVAL, generation_config, safety_settings,
+)
 
-app = Flask(__name__)
+app = Quart(__name__)
 
-# --- 設定エリア ---
-GENAI_API_KEY = os.environ.get("GEMINI_API_KEY")
-genai.configure(api_key=GENAI_API_KEY)
+def ojsonify(obj, status=200):
+    """orjsonでJSONレスポンスを作る（日本語を \\uXXXX にせずUTF-8のまま返す）"""
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
 
-SERVICE_ACCOUNT_FILE = '/etc/secrets/credentials.json'
-DRIVE_FOLDER_ID = '1fJ3Mbrcw-joAsX33aBu0z4oSQu7I0PhP' 
-SPREADSHEET_ID = '1NK0ixXY9hOWuMib22wZxmFX6apUV7EhTDawTXPganZg'
+# --- 設定エリア（内容は config.py） ---
+genai.configure(api_key=GENAI_API_KEY)
 
-# --- モデル設定 ---
-generation_config = {
-    "temperature": 0.1,
-    "top_p": 0.95,
-    "top_k": 40,
-    "max_output_tokens": 8192,
+# ペルソナ設定
+ROLE_INSTRUCTION = {
+    '在校生': "相手は【在校生】です。先輩や先生のような親しみやすい口調で答えてください。",
+    '受験生': "相手は【受験生】です。優しく歓迎するような口調で答えてください。",
+    '保護者': "相手は【保護者】です。丁寧で信頼感のある口調で答えてください。",
 }
 
-# 安全フィルター解除（誤検知防止）
-safety_settings = [
-    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-]
-
-model = genai.GenerativeModel(
-    model_name='models/gemini-2.5-flash',
-    generation_config=generation_config,
-    safety_settings=safety_settings
-)
+# プロンプト（ファイル情報を組み込む）
+SYSTEM_TEMPLATE = """
+    あなたは学校の公式質問応答AIです。
+    現在の対話相手設定：{role_instruction}
+    
+    【参照資料の状況】
+    {file_count_info}
+    
+    【回答の絶対ルール】
+    1. 添付された資料(PDF)の内容のみを根拠に回答してください。
+    2. ユーザーから「どんなファイルを見ていますか？」「資料は何個ありますか？」と聞かれた場合は、上記の【参照資料の状況】の情報をそのまま伝えてください。
+    3. 資料内のグラフ、地図、写真の情報も読み取って回答してください。
+    4. あなた自身の知識や推測は混ぜないでください。
+    5. 回答の最後には必ず【参照元：ファイル名 (P.ページ数)】を明記してください。
+    """
 
 # グローバル変数
-UPLOADED_FILES_CACHE = {'在校生': [], '受験生': [], '保護者': []}
+UPLOADED_FILES_CACHE = {role: [] for role in TARGET_ROLES}
+TARGET_FILE_PARTS = {}  # 毎回の質問に添える資料パーツ（アップロード済みファイルは file_uri 参照にしておく）
 FILE_LIST_DATA = []
-
+ROLE_CACHE = {}
+MODELS = {}
+SYSTEM_PROMPT_PREFIX = {}
+KB_VERSION = {}
+DOC_EMB = {}
+INGEST_INDEX = {}
+PDF_BYTES = {}  # 取り込み中のインラインPDF {DriveファイルID: バイト列}（埋め込み作成で再ダウンロードしないため）
+LOG_Q = queue.Queue()
+RESP_CACHE = TTLCache(maxsize=REPLY_CACHE_SIZE, ttl=REPLY_CACHE_TTL)
+SEM_CACHE = TTLCache(maxsize=REPLY_CACHE_SIZE, ttl=REPLY_CACHE_TTL)  # {(役割, 質問, 版): (埋め込み, 回答)}
+INFLIGHT = {}
+RESP_LOCK = threading.Lock()
+READY = threading.Event()
+
+@lru_cache(maxsize=1)
 def get_credentials():
-    """認証情報を取得"""
+    """認証情報を取得（鍵ファイルの読み込みと解析はプロセスごとに1回だけ）"""
     creds_path = SERVICE_ACCOUNT_FILE
     if not os.path.exists(creds_path):
         creds_path = 'credentials.json'
@@ -55,185 +100,606 @@ def get_credentials():
     scopes = ['https://www.googleapis.com/auth/drive.readonly', 'https://www.googleapis.com/auth/spreadsheets']
     return service_account.Credentials.from_service_account_file(creds_path, scopes=scopes)
 
+def build_drive_service(creds):
+    """Drive APIクライアントを作成（httplib2はスレッドセーフでないため、リクエストごとに接続を分ける）"""
+    def build_request(http, *args, **kwargs):
+        return HttpRequest(AuthorizedHttp(creds, http=httplib2.Http()), *args, **kwargs)
+    # ディスカバリー文書はライブラリ同梱のものを使い、取得の通信もディスクキャッシュも使わない
+    return build('drive', 'v3', credentials=creds, requestBuilder=build_request,
+                 cache_discovery=False, static_discovery=True)
+
+# --- Google API クライアント（起動時に一度だけ作って使い回す） ---
+CREDS = get_credentials()
+SESSION = None
+DRIVE = None
+GSPREAD = None
+if CREDS:
+    # Sheets への通信とPDFのダウンロードは、接続プールを持つ1つのセッションに集約する
+    SESSION = AuthorizedSession(CREDS)
+    SESSION.mount('https://', HTTPAdapter(pool_connections=50, pool_maxsize=50, max_retries=Retry(total=3, backoff_factor=0.3)))
+    DRIVE = build_drive_service(CREDS)
+    GSPREAD = gspread.Client(auth=CREDS, session=SESSION)
+
+def build_system_instruction(user_role, file_names):
+    """役割と資料ファイル名からシステムプロンプト（会話履歴を除く部分）を作る"""
+    # ★追加：AIに「今持っているファイル情報」を言葉で教える処理
+    if file_names:
+        # ファイル名リストを作成
+        file_names_str = "\n".join([f"・{name}" for name in file_names])
+        file_count_info = f"あなたは現在、以下の【合計{len(file_names)}つ】のファイルを資料として持っています：\n{file_names_str}"
+    else:
+        file_count_info = "現在、参照できる資料ファイルはありません。"
+
+    return SYSTEM_TEMPLATE.format(
+        role_instruction=ROLE_INSTRUCTION.get(user_role, ""),
+        file_count_info=file_count_info
+    )
+
+def create_role_cache(role, role_files, system_instruction):
+    """役割ごとの資料とシステムプロンプトをコンテキストキャッシュに登録する"""
+    try:
+        cache = caching.CachedContent.create(
+            model=MODEL_NAME,
+            display_name=f'kb-{role}',
+            system_instruction=system_instruction,
+            contents=role_files,
+            ttl=CACHE_TTL,
+        )
+        print(f"Cache Created [{role}]: {cache.name}")
+        return cache
+    except Exception as e:
+        # 資料のトークン数が最小値に満たない場合なども含め、従来の送信方式に戻す
+        print(f"Cache Create Error [{role}]: {e}")
+        return None
+
+def delete_role_caches(caches):
+    """渡されたコンテキストキャッシュをすべて削除する"""
+    for role, cache in caches.items():
+        try:
+            cache.delete()
+        except Exception as e:
+            print(f"Cache Delete Error [{role}]: {e}")
+
+def keep_caches_alive():
+    """有効期限が切れる前にキャッシュのTTLを延長し、失われたキャッシュは作り直す（バックグラウンド用）"""
+    while True:
+        time.sleep(CACHE_REFRESH_INTERVAL)
+        # 取り込み中にキャッシュを作ると二重にできるので、取り込みと同じロックを取る
+        with ingest_lock():
+            refresh_role_caches()
+
+def refresh_role_caches():
+    """キャッシュのTTLを延長し、期限切れや作成に失敗したキャッシュを作り直す"""
+    for role, cache in list(ROLE_CACHE.items()):
+        try:
+            cache.update(ttl=CACHE_TTL)
+        except google_exceptions.NotFound:
+            # 期限切れのキャッシュを参照し続けないよう、下で作り直すまで資料を毎回送る方式に戻す
+            print(f"Cache Expired [{role}]")
+            ROLE_CACHE.pop(role, None)
+            MODELS[role] = build_role_model(role, None, SYSTEM_PROMPT_PREFIX.get(role))
+        except Exception as e:
+            # 一時的なエラーではキャッシュは残っているので、次の周期で延長し直す
+            print(f"Cache Update Error [{role}]: {e}")
+
+    # キャッシュが無い役割は毎回資料を送ることになるので、作り直せるなら作り直す
+    for role, files in list(UPLOADED_FILES_CACHE.items()):
+        if not files or role in ROLE_CACHE or role not in SYSTEM_PROMPT_PREFIX:
+            continue
+        cache = create_role_cache(role, files, SYSTEM_PROMPT_PREFIX[role])
+        if cache:
+            # モデルを先に差し替える（逆だと、資料を添えないキャッシュ無しのモデルで答えてしまう）
+            MODELS[role] = build_role_model(role, cache, SYSTEM_PROMPT_PREFIX[role])
+            ROLE_CACHE[role] = cache
+
+def list_all_files(service, query, fields):
+    """files().list を最後のページまで取得する"""
+    files = []
+    page_token = None
+    while True:
+        res = service.files().list(q=query, fields=f"nextPageToken, {fields}", pageSize=1000, pageToken=page_token).execute()
+        files.extend(res.get('files', []))
+        page_token = res.get('nextPageToken')
+        if not page_token: return files
+
+def load_ingest_index():
+    """取り込み済みPDFの記録 {DriveファイルID:md5: Geminiファイル名} を読み込む"""
+    try:
+        with open(INGEST_INDEX_FILE, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_ingest_index(index):
+    """取り込み済みPDFの記録を書き出す（途中で落ちても壊れないよう置き換えで保存）"""
+    tmp_path = INGEST_INDEX_FILE + '.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, INGEST_INDEX_FILE)
+    except OSError as e:
+        print(f"Index Save Error: {e}")
+
+def delete_stale_files(old_index, new_index):
+    """前回の記録にあって今回使わなくなったファイルだけを削除する（古い版が容量を使い続けないように）"""
+    # 同じAPIキーを使う他の環境のファイルには触れない
+    for name in set(old_index.values()) - set(new_index.values()):
+        try:
+            print(f"Delete Stale File: {name}")
+            genai.delete_file(name)
+        except Exception as e:
+            print(f"Stale File Cleanup Error: {e}")
+
+def ingest_key(item):
+    return f"{item['id']}:{item.get('md5Checksum', '')}"
+
+def download_pdf(item):
+    """DriveからPDFをメモリ上のバッファにダウンロードする（共有セッションの接続を使い回す）"""
+    url = f"https://www.googleapis.com/drive/v3/files/{item['id']}?alt=media"
+    buf = io.BytesIO()
+    download = ChunkedDownload(url, DOWNLOAD_CHUNK_SIZE, buf)
+    while not download.finished: download.consume_next_chunk(SESSION)
+    buf.seek(0)
+    return buf
+
+def _ingest(item, role, inline=False):
+    """PDFを1件取り込む（inline なら Part として返し、それ以外はGeminiにアップロードして処理完了は待たない）"""
+    print(f"Processing [{role}]: {item['name']}...")
+
+    # 内容が同じPDFをアップロード済みなら、Gemini側のファイルをそのまま使う
+    cached_name = INGEST_INDEX.get(ingest_key(item))
+    if cached_name:
+        try:
+            uploaded_file = genai.get_file(cached_name)
+            if uploaded_file.state.name == "ACTIVE":
+                print(f"Reuse Uploaded File: {item['name']}")
+                return uploaded_file
+        except Exception as e:
+            print(f"Reuse Error: {e}")
+
+    try:
+        # 一時ファイルを介さず、メモリ上のバッファに落としてそのままアップロードする
+        buf = download_pdf(item)
+
+        if inline:
+            # 小さいPDFはアップロードと処理待ちを省き、バイト列をそのままリクエストに含める
+            print(f"Inline: {item['name']}")
+            data = buf.getvalue()
+            # どのみちメモリに持つバイト列なので、埋め込み作成にも使い回す（アップロードするPDFは持ち続けない）
+            PDF_BYTES[item['id']] = data
+            return genai.protos.Part(inline_data=genai.protos.Blob(mime_type='application/pdf', data=data))
+
+        return genai.upload_file(path=buf, mime_type='application/pdf', display_name=item['name'])
+    except Exception as upload_error:
+        print(f"Upload Error: {upload_error}")
+        return None
+
+def embed_pdf(item):
+    """PDFの本文を取り出して埋め込みベクトルを作る（文字が取れないPDFは None）"""
+    try:
+        # インラインで取り込んだPDFはそのバイト列を使い、それ以外はここでダウンロードする
+        data = PDF_BYTES.get(item['id'])
+        reader = PdfReader(io.BytesIO(data) if data is not None else download_pdf(item))
+        text = "\n".join(page.extract_text() or "" for page in reader.pages)[:EMBED_TEXT_LIMIT]
+        if not text.strip(): return None
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=text, task_type='retrieval_document')
+        embedding = np.array(result['embedding'])
+        return embedding / np.linalg.norm(embedding)
+    except Exception as e:
+        print(f"Embedding Error: {item['name']}: {e}")
+        return None
+
+def build_doc_embeddings(items):
+    """役割内の資料の埋め込みを (行列, 資料の位置) にまとめる（作れたものが無ければ None）"""
+    with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+        embeddings = list(executor.map(embed_pdf, items))
+
+    indices = [i for i, e in enumerate(embeddings) if e is not None]
+    if not indices: return None
+    return np.stack([embeddings[i] for i in indices]), indices
+
+def select_relevant_files(user_role, user_message, target_files):
+    """質問に近い上位 RETRIEVAL_TOP_K 件の資料だけを選ぶ（本文の取れない資料は常に含める）"""
+    doc_emb = DOC_EMB.get(user_role)
+    if not doc_emb: return target_files
+    matrix, indices = doc_emb
+    if len(indices) <= RETRIEVAL_TOP_K: return target_files
+
+    try:
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=user_message, task_type='retrieval_query')
+    except Exception as e:
+        print(f"Embedding Error: {e}")
+        return target_files
+    scores = matrix @ np.array(result['embedding'])
+    top_idx = np.argpartition(-scores, RETRIEVAL_TOP_K)[:RETRIEVAL_TOP_K]
+
+    selected = {indices[i] for i in top_idx}
+    ranked = set(indices)
+    return [f for i, f in enumerate(target_files) if i in selected or i not in ranked]
+
+def to_file_part(f):
+    """資料を質問に添えるPartにする（インラインのPartはそのまま、アップロード済みファイルは file_uri で参照）"""
+    if isinstance(f, genai.protos.Part): return f
+    return genai.protos.Part(file_data=genai.protos.FileData(mime_type=f.mime_type, file_uri=f.uri))
+
+def plan_inline(items):
+    """サイズの小さい順に、合計が INLINE_PDF_BUDGET に収まるPDFをインラインにする（対象のIDを返す）"""
+    inline_ids = set()
+    inline_total = 0
+    for item in sorted(items, key=lambda i: int(i.get('size', INLINE_PDF_BUDGET))):
+        size = int(item.get('size', INLINE_PDF_BUDGET))
+        if inline_total + size > INLINE_PDF_BUDGET: break
+        inline_ids.add(item['id'])
+        inline_total += size
+    return inline_ids
+
+def refresh_file_state(f):
+    """PROCESSING中のファイルだけ最新の状態を取り直す"""
+    if f.state.name != "PROCESSING":
+        return f
+    try:
+        return genai.get_file(f.name)
+    except Exception as upload_error:
+        print(f"Upload Error: {upload_error}")
+        return None
+
+def wait_until_active(uploaded_files):
+    """PROCESSING中のファイルをまとめてポーリングし、ACTIVEになったものだけを返す"""
+    pending = list(uploaded_files)
+
+    delay = UPLOAD_POLL_INITIAL_DELAY
+    deadline = time.monotonic() + UPLOAD_POLL_TIMEOUT
+    with ThreadPoolExecutor(max_workers=UPLOAD_POLL_WORKERS) as poller:
+        while any(f.state.name == "PROCESSING" for f in pending) and time.monotonic() < deadline:
+            time.sleep(delay)
+            delay = min(delay * UPLOAD_POLL_BACKOFF, UPLOAD_POLL_MAX_DELAY)
+            pending = [f for f in poller.map(refresh_file_state, pending) if f is not None]
+
+    active_files = []
+    for f in pending:
+        if f.state.name == "ACTIVE":
+            active_files.append(f)
+            print(f"Upload Complete: {f.display_name}")
+        else:
+            print(f"Upload Failed: {f.display_name}")
+    return active_files
+
 def load_and_upload_pdfs_by_role():
     """役割ごとのフォルダからPDFを読み込み、アップロードする"""
-    global UPLOADED_FILES_CACHE, FILE_LIST_DATA
+    global UPLOADED_FILES_CACHE, TARGET_FILE_PARTS, FILE_LIST_DATA, MODELS, ROLE_CACHE, SYSTEM_PROMPT_PREFIX, KB_VERSION, DOC_EMB, INGEST_INDEX
     
-    creds = get_credentials()
-    if not creds: return
+    if not DRIVE: return
     
-    service = build('drive', 'v3', credentials=creds)
+    service = DRIVE
     
-    # リセット
-    UPLOADED_FILES_CACHE = {'在校生': [], '受験生': [], '保護者': []}
-    FILE_LIST_DATA = []
+    # 新しい状態はローカルに組み立て、最後にまとめて差し替える（読み込み中も今の資料で回答を続ける）
+    new_files = {role: [] for role in TARGET_ROLES}
+    new_parts = {}
+    new_file_list = []
+    new_caches = {}
+    new_prompts = {}
+    new_versions = {}
+    new_doc_emb = {}
+    INGEST_INDEX = load_ingest_index()
+    new_index = {}
+    load_complete = False
     
-    target_roles = ['在校生', '受験生', '保護者']
 
     try:
-        for role in target_roles:
-            print(f"--- Searching folder for: {role} ---")
-            
-            query_folder = f"'{DRIVE_FOLDER_ID}' in parents and mimeType='application/vnd.google-apps.folder' and name='{role}' and trashed=false"
-            results = service.files().list(q=query_folder, fields="files(id, name)").execute()
-            folders = results.get('files', [])
-            
-            if not folders:
+        # 役割フォルダの検索とPDF一覧の取得は、それぞれ全役割分を1回のクエリにまとめる
+        print(f"--- Searching folders for: {', '.join(TARGET_ROLES)} ---")
+        names_query = " or ".join(f"name='{role}'" for role in TARGET_ROLES)
+        query_folder = f"'{DRIVE_FOLDER_ID}' in parents and mimeType='application/vnd.google-apps.folder' and ({names_query}) and trashed=false"
+        folder_id_to_role = {}
+        for folder in list_all_files(service, query_folder, "files(id, name)"):
+            if folder['name'] not in folder_id_to_role.values():
+                folder_id_to_role[folder['id']] = folder['name']
+
+        file_results = {}
+        for role in TARGET_ROLES:
+            if role not in folder_id_to_role.values():
                 print(f"Folder '{role}' not found.")
                 continue
-                
-            folder_id = folders[0]['id']
-            
-            query_files = f"'{folder_id}' in parents and mimeType='application/pdf' and trashed=false"
-            res_files = service.files().list(q=query_files, fields="files(id, name, webViewLink)").execute()
-            items = res_files.get('files', [])
-            
-            if not items: continue
-
-            role_files = []
-
+            file_results[role] = []
+
+        if folder_id_to_role:
+            parents_query = " or ".join(f"'{folder_id}' in parents" for folder_id in folder_id_to_role)
+            query_files = f"({parents_query}) and mimeType='application/pdf' and trashed=false"
+            for item in list_all_files(service, query_files, "files(id, name, webViewLink, size, md5Checksum, modifiedTime, parents)"):
+                for parent in item.get('parents', []):
+                    if parent in folder_id_to_role:
+                        file_results[folder_id_to_role[parent]].append(item)
+
+        # 全役割のPDFを1つのスレッドプールでまとめて取り込む
+        jobs = []
+        for role in file_results:
+            items = file_results[role]
             for item in items:
-                print(f"Processing [{role}]: {item['name']}...")
-                
-                FILE_LIST_DATA.append({
+                new_file_list.append({
                     'name': item['name'],
                     'url': item.get('webViewLink', '#'),
                     'role': role 
                 })
+            inline_ids = plan_inline(items)
+            jobs.extend((item, role, item['id'] in inline_ids) for item in items)
+
+        with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+            results = list(executor.map(lambda job: _ingest(*job), jobs))
+
+        uploaded = [f for f in results if isinstance(f, genai.types.File)]
+        active_files = {f.name: f for f in wait_until_active(uploaded)}
+
+        # 結果を役割ごとにまとめる
+        role_files = {role: [] for role in file_results}
+        role_items = {role: [] for role in file_results}
+        for (item, role, _), result in zip(jobs, results):
+            if isinstance(result, genai.protos.Part):
+                role_files[role].append(result)
+            elif result and result.name in active_files:
+                role_files[role].append(active_files[result.name])
+                new_index[ingest_key(item)] = result.name
+            else:
+                continue
+            role_items[role].append(item)
 
-                request = service.files().get_media(fileId=item['id'])
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                    downloader = MediaIoBaseDownload(tmp_file, request)
-                    done = False
-                    while done is False: _, done = downloader.next_chunk()
-                    tmp_path = tmp_file.name
-
-                try:
-                    uploaded_file = genai.upload_file(path=tmp_path, display_name=item['name'])
-                    
-                    retry_count = 0
-                    while uploaded_file.state.name == "PROCESSING" and retry_count < 30:
-                        time.sleep(2)
-                        uploaded_file = genai.get_file(uploaded_file.name)
-                        retry_count += 1
-                    
-                    if uploaded_file.state.name == "ACTIVE":
-                        role_files.append(uploaded_file)
-                        print(f"Upload Complete: {item['name']}")
-                    else:
-                        print(f"Upload Failed: {item['name']}")
-
-                except Exception as upload_error:
-                    print(f"Upload Error: {upload_error}")
-                finally:
-                    if os.path.exists(tmp_path): os.remove(tmp_path)
+        for role in file_results:
+            files = role_files[role]
+            items = role_items[role]
             
-            UPLOADED_FILES_CACHE[role] = role_files
+            new_files[role] = files
+            new_parts[role] = [to_file_part(f) for f in files]
+            # システムプロンプトは資料が変わったときだけ作り直す
+            new_prompts[role] = build_system_instruction(role, [item['name'] for item in items])
+            new_versions[role] = hashlib.sha256(''.join(sorted(ingest_key(item) for item in items)).encode()).hexdigest()[:12]
+            if files:
+                cache = create_role_cache(role, files, new_prompts[role])
+                if cache: new_caches[role] = cache
+
+            # キャッシュが無く毎回資料を送る役割は、質問ごとに関連する資料だけを選んで送る
+            if role not in new_caches and len(items) > RETRIEVAL_TOP_K:
+                doc_emb = build_doc_embeddings(items)
+                if doc_emb: new_doc_emb[role] = doc_emb
+
+        load_complete = True
 
     except Exception as e:
         print(f"Drive Process Error: {e}")
+    PDF_BYTES.clear()
+
+    if not load_complete:
+        # 途中で失敗した場合は今の資料のまま回答を続け、作りかけのキャッシュは捨てる。取り込みの記録も上書きしない
+        # （空の記録で上書きすると、次の読み込みで全件を再アップロードし、前のファイルは消されずに残ってしまう）
+        delete_role_caches(new_caches)
+        return UPLOADED_FILES_CACHE, FILE_LIST_DATA
+
+    new_models = {role: build_role_model(role, new_caches.get(role), new_prompts.get(role)) for role in TARGET_ROLES}
+    old_caches = ROLE_CACHE
+    MODELS, ROLE_CACHE, TARGET_FILE_PARTS, UPLOADED_FILES_CACHE = new_models, new_caches, new_parts, new_files
+    SYSTEM_PROMPT_PREFIX, KB_VERSION, DOC_EMB, FILE_LIST_DATA = new_prompts, new_versions, new_doc_emb, new_file_list
+    with RESP_LOCK:
+        RESP_CACHE.clear()
+        SEM_CACHE.clear()
+    # 古いキャッシュは、差し替えが終わってから消す
+    delete_role_caches(old_caches)
+
+    # 取り込みの記録を更新し、使わなくなったアップロードを掃除する
+    old_index, INGEST_INDEX = INGEST_INDEX, new_index
+    save_ingest_index(INGEST_INDEX)
+    delete_stale_files(old_index, new_index)
 
     return UPLOADED_FILES_CACHE, FILE_LIST_DATA
 
+@contextmanager
+def ingest_lock():
+    """取り込みとキャッシュの作り直しを、他のスレッドやワーカーと同時に行わないためのファイルロック"""
+    with open(INGEST_LOCK_FILE, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def load_with_ingest_lock():
+    """他のワーカーと同時に取り込まないよう、ファイルロックを取ってから読み込む"""
+    # 後から来たワーカーは先の取り込みが終わるのを待つので、アップロード済みの記録をそのまま再利用できる
+    with ingest_lock():
+        return load_and_upload_pdfs_by_role()
+
+def warmup():
+    """起動時の取り込み（バックグラウンド用）"""
+    try:
+        load_with_ingest_lock()
+    finally:
+        READY.set()
+        print("System Ready.")
+
+def _log_worker():
+    """キューに溜まった会話ログを一定間隔でまとめて書き込む（バックグラウンド用）"""
+    sheet = None  # 開いたシートは使い回す（毎回開くとメタデータ取得の往復が増える）
+    while True:
+        rows = [LOG_Q.get()]
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        while len(rows) < LOG_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0: break
+            try:
+                rows.append(LOG_Q.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        try:
+            if sheet is None:
+                sheet = GSPREAD.open_by_key(SPREADSHEET_ID).sheet1
+            sheet.append_rows(rows, value_input_option='RAW')
+        except Exception as e:
+            print(f"Logging Error: {e}")
+            sheet = None  # 次回は開き直す
+        finally:
+            for _ in rows: LOG_Q.task_done()
+
 def save_log_to_sheet(user_msg, bot_msg, role):
+    """会話ログをキューに積む（書き込みはバックグラウンドで行うので応答を待たせない）"""
+    if not GSPREAD: return
+    now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    LOG_Q.put([now, role, user_msg, bot_msg])
+
+def build_role_model(role, role_cache, system_instruction):
+    """役割ごとの回答用モデルを作る（システムプロンプトはモデル作成時に一度だけ渡す）"""
+    if role_cache:
+        # 資料とシステムプロンプトはキャッシュ側にあるので、会話履歴と質問だけを送る
+        return genai.GenerativeModel.from_cached_content(
+            cached_content=role_cache,
+            generation_config=generation_config,
+            safety_settings=safety_settings
+        )
+
+    # キャッシュが作れなかった役割は、資料を毎回リクエストに含める
+    return genai.GenerativeModel(
+        model_name=MODEL_NAME,
+        generation_config=generation_config,
+        safety_settings=safety_settings,
+        system_instruction=system_instruction or build_system_instruction(role, [])
+    )
+
+def get_chat_model(user_role, user_message):
+    """役割に応じた回答用モデルと、質問に添える資料パーツを返す"""
+    chat_model = MODELS.get(user_role) or build_role_model(user_role, ROLE_CACHE.get(user_role), SYSTEM_PROMPT_PREFIX.get(user_role))
+    if user_role in ROLE_CACHE:
+        return chat_model, []
+    target_files = TARGET_FILE_PARTS.get(user_role, [])
+    return chat_model, select_relevant_files(user_role, user_message, target_files)
+
+def generate_reply(user_role, history_contents, user_message):
+    """Geminiで回答を生成する（安全フィルターで止められた場合は ValueError）"""
+    chat_model, file_parts = get_chat_model(user_role, user_message)
+    request_content = history_contents + [{'role': 'user', 'parts': [*file_parts, user_message]}]
+    response = chat_model.generate_content(request_content)
+    try:
+        return response.text
+    except ValueError:
+        print(f"Blocked: {response.prompt_feedback}")
+        raise
+
+def embed_question(text):
+    """質問文の埋め込みベクトルを作る（失敗したら None）"""
     try:
-        creds = get_credentials()
-        if not creds: return
-        client = gspread.authorize(creds)
-        sheet = client.open_by_key(SPREADSHEET_ID).sheet1
-        now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        sheet.append_row([now, role, user_msg, bot_msg])
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=text, task_type='semantic_similarity')
     except Exception as e:
-        print(f"Logging Error: {e}")
+        print(f"Embedding Error: {e}")
+        return None
+    embedding = np.array(result['embedding'])
+    return embedding / np.linalg.norm(embedding)
+
+def find_similar_reply(role, kb_ver, q_vec):
+    """言い回しの近い過去の質問があれば、その回答を返す"""
+    with RESP_LOCK:
+        entries = [entry for (r, _, v), entry in SEM_CACHE.items() if r == role and v == kb_ver]
+    if not entries: return None
+    scores = np.stack([vec for vec, _ in entries]) @ q_vec
+    best = int(np.argmax(scores))
+    return entries[best][1] if scores[best] >= SEMANTIC_CACHE_THRESHOLD else None
+
+def _cached_reply(role, kb_ver, user_message):
+    """会話の最初の質問への回答を使い回す（同じ質問が同時に来たらGeminiへの問い合わせは1回にまとめる）"""
+    # 表記ゆれを吸収した文面はキャッシュのキーにだけ使い、Geminiには入力どおりの質問を送る
+    norm_q = ' '.join(user_message.lower().split())
+    key = (role, norm_q, kb_ver)
+    with RESP_LOCK:
+        bot_reply = RESP_CACHE.get(key)
+        if bot_reply is not None:
+            return bot_reply
+        event = INFLIGHT.get(key)
+        is_leader = event is None
+        if is_leader:
+            event = INFLIGHT[key] = threading.Event()
+
+    if not is_leader:
+        # 先に来た同じ質問の回答を待つ
+        event.wait()
+        with RESP_LOCK:
+            bot_reply = RESP_CACHE.get(key)
+        if bot_reply is not None:
+            return bot_reply
+        # 先行リクエストが失敗した場合は自分で生成する
+        return generate_reply(role, [], user_message)
+
+    try:
+        # 文面が一致しなくても、意味の近い質問の回答があればそれを使う
+        q_vec = embed_question(user_message)
+        bot_reply = find_similar_reply(role, kb_ver, q_vec) if q_vec is not None else None
+        generated = bot_reply is None
+        if generated:
+            bot_reply = generate_reply(role, [], user_message)
+        with RESP_LOCK:
+            RESP_CACHE[key] = bot_reply
+            # 借りた回答まで登録すると、似た質問の連鎖で元の質問から離れた質問にも同じ回答が返ってしまう
+            if generated and q_vec is not None: SEM_CACHE[key] = (q_vec, bot_reply)
+        return bot_reply
+    finally:
+        with RESP_LOCK:
+            INFLIGHT.pop(key, None)
+        event.set()
 
 # 起動時
+# 取り込みは裏で進め、ポートはすぐに開く（終わるまで /chat は 503 を返す）
 print("System starting... Uploading files by role...")
-load_and_upload_pdfs_by_role()
-print("System Ready.")
+threading.Thread(target=warmup, daemon=True).start()
+threading.Thread(target=keep_caches_alive, daemon=True).start()
+threading.Thread(target=_log_worker, daemon=True).start()
+atexit.register(LOG_Q.join)  # 終了前に残りのログを書き込む
+
+@app.before_serving
+async def setup_executor():
+    # Gemini への問い合わせはブロッキングなのでスレッドに逃がす。同時に待てる数をここで決める
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=CHAT_WORKERS))
+
+@app.before_request
+async def wait_for_warmup():
+    if request.path == '/chat' and not READY.is_set():
+        return ojsonify({'error': '準備中です。しばらくしてからもう一度お試しください。'}, 503)
 
 @app.route('/')
-def index():
-    return render_template('index.html', files=FILE_LIST_DATA)
+async def index():
+    return await render_template('index.html', files=FILE_LIST_DATA, ready=READY.is_set())
 
 @app.route('/refresh')
-def refresh_data():
+async def refresh_data():
     print("Refreshing data...")
-    load_and_upload_pdfs_by_role()
-    return jsonify({'status': 'success', 'message': '更新完了', 'files': FILE_LIST_DATA})
+    await asyncio.to_thread(load_with_ingest_lock)
+    return ojsonify({'status': 'success', 'message': '更新完了', 'files': FILE_LIST_DATA})
 
 @app.route('/chat', methods=['POST'])
-def chat():
-    data = request.json
+async def chat():
+    data = await request.get_json()
     user_message = data.get('message')
     history_list = data.get('history', [])
-    user_role = data.get('role', '在校生')
+    user_role = data.get('role')
+    if user_role not in TARGET_ROLES:
+        # 想定外の立場ではモデルを毎回作ることになるので、既定の立場として扱う
+        user_role = TARGET_ROLES[0]
     
     if not user_message:
-        return jsonify({'error': 'No message provided'}), 400
-
-    history_text = ""
-    for chat in history_list[-4:]: 
-        role = "User" if chat['role'] == 'user' else "AI"
-        content = chat['text']
-        history_text += f"{role}: {content}\n"
-
-    # 対象ファイルを取得
-    target_files = UPLOADED_FILES_CACHE.get(user_role, [])
-
-    # ★追加：AIに「今持っているファイル情報」を言葉で教える処理
-    if target_files:
-        # ファイル名リストを作成
-        file_names_str = "\n".join([f"・{f.display_name}" for f in target_files])
-        file_count_info = f"あなたは現在、以下の【合計{len(target_files)}つ】のファイルを資料として持っています：\n{file_names_str}"
-    else:
-        file_count_info = "現在、参照できる資料ファイルはありません。"
-
-    # ペルソナ設定
-    role_instruction = ""
-    if user_role == '在校生':
-        role_instruction = "相手は【在校生】です。先輩や先生のような親しみやすい口調で答えてください。"
-    elif user_role == '受験生':
-        role_instruction = "相手は【受験生】です。優しく歓迎するような口調で答えてください。"
-    elif user_role == '保護者':
-        role_instruction = "相手は【保護者】です。丁寧で信頼感のある口調で答えてください。"
-
-    # プロンプト（ファイル情報を組み込む）
-    system_instruction = f"""
-    あなたは学校の公式質問応答AIです。
-    現在の対話相手設定：{role_instruction}
-    
-    【参照資料の状況】
-    {file_count_info}
-    
-    【回答の絶対ルール】
-    1. 添付された資料(PDF)の内容のみを根拠に回答してください。
-    2. ユーザーから「どんなファイルを見ていますか？」「資料は何個ありますか？」と聞かれた場合は、上記の【参照資料の状況】の情報をそのまま伝えてください。
-    3. 資料内のグラフ、地図、写真の情報も読み取って回答してください。
-    4. あなた自身の知識や推測は混ぜないでください。
-    5. 回答の最後には必ず【参照元：ファイル名 (P.ページ数)】を明記してください。
-    
-    [これまでの会話]
-    """ + history_text
+        return ojsonify({'error': 'No message provided'}, 400)
 
-    request_content = [system_instruction]
-    if target_files:
-        request_content.extend(target_files)
-    request_content.append(f"\n[ユーザーの質問]\n{user_message}")
+    # 会話履歴はテキストに埋め込まず、発話ごとのContentとして渡す
+    history_contents = [
+        {'role': 'user' if c['role'] == 'user' else 'model', 'parts': [c['text']]}
+        for c in history_list[-HISTORY_TURNS:]
+    ]
 
     try:
-        response = model.generate_content(request_content)
         try:
-            bot_reply = response.text
+            if history_list:
+                bot_reply = await asyncio.to_thread(generate_reply, user_role, history_contents, user_message)
+            else:
+                # よくある質問は同じ文面で来ることが多いので、初回の質問だけ回答を使い回す
+                bot_reply = await asyncio.to_thread(_cached_reply, user_role, KB_VERSION.get(user_role, ''), user_message)
         except ValueError:
-            print(f"Blocked: {response.prompt_feedback}")
             bot_reply = "申し訳ありません。安全フィルターにより回答が生成できませんでした。"
 
         save_log_to_sheet(user_message, bot_reply, user_role)
-        return jsonify({'reply': bot_reply})
+        return ojsonify({'reply': bot_reply})
 
     except Exception as e:
         print(f"Gemini Error: {e}")
-        return jsonify({'reply': 'エラーが発生しました。'}), 500
+        return ojsonify({'reply': 'エラーが発生しました。'}, 500)
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,71 @@
+import os
+import datetime
+
+# --- 設定エリア ---
+GENAI_API_KEY = os.environ.get("GEMINI_API_KEY")
+
+SERVICE_ACCOUNT_FILE = '/etc/secrets/credentials.json'
+DRIVE_FOLDER_ID = '1fJ3Mbrcw-joAsX33aBu0z4oSQu7I0PhP' 
+SPREADSHEET_ID = '1NK0ixXY9hOWuMib22wZxmFX6apUV7EhTDawTXPganZg'
+
+# 利用者の立場（Drive上のフォルダ名と一致させる）
+TARGET_ROLES = ('在校生', '受験生', '保護者')
+
+# 同時に処理できる /chat の数（Gemini の応答待ちに使うスレッド数）
+CHAT_WORKERS = 64
+
+# 会話ログ（まとめてスプレッドシートに書き込む）
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 2  # 秒
+
+# Geminiに渡す会話履歴の件数（直近の発話から）
+HISTORY_TURNS = 4
+
+# 同じ質問への回答を使い回す件数と期間
+REPLY_CACHE_SIZE = 1024
+REPLY_CACHE_TTL = 300  # 秒
+SEMANTIC_CACHE_THRESHOLD = 0.95  # 言い回しが違っても、埋め込みのコサイン類似度がこれ以上なら同じ質問とみなす
+
+# PDF取り込み（ダウンロード・アップロードを並列で行う）
+INGEST_WORKERS = 16
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # バイト。ほとんどのPDFが1〜2回で落ちる大きさ
+UPLOAD_POLL_INITIAL_DELAY = 0.25  # 秒。以降は指数的に延ばす
+UPLOAD_POLL_MAX_DELAY = 2.0  # 秒
+UPLOAD_POLL_BACKOFF = 1.5
+UPLOAD_POLL_WORKERS = 4  # 状態確認を並列に行うスレッド数
+UPLOAD_POLL_TIMEOUT = 60  # 秒
+
+# この合計サイズまでのPDFはアップロードせず、バイト列のまま（インラインで）渡す
+INLINE_PDF_BUDGET = 15 * 1024 * 1024  # バイト（役割ごと）
+
+# 取り込み済みPDFの記録（Driveのファイル内容が変わっていなければ再アップロードしない）
+INGEST_INDEX_FILE = os.path.expanduser('~/.urayaba_cache.json')
+INGEST_LOCK_FILE = '/tmp/ingest.lock'  # 複数ワーカーが同時に取り込まないためのロック
+
+# --- モデル設定 ---
+MODEL_NAME = 'models/gemini-2.5-flash'
+
+# 資料の絞り込み（キャッシュが使えない役割だけ、質問に近い資料を選んで送る）
+EMBEDDING_MODEL = 'models/text-embedding-004'
+EMBED_TEXT_LIMIT = 8000  # 文字。埋め込みに使うPDF本文の長さ
+RETRIEVAL_TOP_K = 3
+
+# コンテキストキャッシュ（資料PDFをサーバー側に保持して毎回の再送信を省く）
+CACHE_REFRESH_INTERVAL = 30 * 60  # 秒。TTLが切れる前に延長する間隔
+# 再起動で延長されなくなったキャッシュがすぐ消えるよう、延長間隔の2倍だけ保持する
+CACHE_TTL = datetime.timedelta(seconds=2 * CACHE_REFRESH_INTERVAL)
+
+generation_config = {
+    "temperature": 0.1,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 8192,
+}
+
+# 安全フィルター解除（誤検知防止）
+safety_settings = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
@@ -0,0 +1,14 @@
+import os
+
+# --- Gunicorn 設定（gunicorn app:app -c gunicorn.conf.py） ---
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = 'uvicorn_worker.UvicornWorker'
+
+# ワーカーは1つにする。1ワーカーで /chat を CHAT_WORKERS 件まで同時に待てる。
+# ワーカーを増やすと、インラインPDFのダウンロード・資料の埋め込み・コンテキストキャッシュが
+# ワーカーごとに作られ、費用が台数分かかる（アップロード済みファイルの再利用だけは共有される）
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+# preload はしない。取り込み・キャッシュ延長・ログ書き込みのスレッドは import 時に起動するため
+# fork 後の子プロセスには引き継がれず、gRPC や接続プールも fork をまたいで共有できない。
+preload_app = False